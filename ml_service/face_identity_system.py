@@ -25,6 +25,8 @@ import chromadb
 from ultralytics import YOLO
 from insightface.app import FaceAnalysis
 
+from profiler import span
+
 import numpy.random._pickle
 
 
@@ -72,13 +74,16 @@ class FaceIdentitySystem:
         # Since we already ran YOLO, we can try to force embedding extraction or just run InsightFace on the crop.
         # get(img) returns list of faces. Since `face_img_crop` is just one face, we expect 1 result.
         print("faces recognizer running...")
-        faces = self.recognizer.get(face_img_crop)
-        print("faces recognizer ran")
-        if not faces:
+        with span("embed", crop_shape=list(face_img_crop.shape)) as s:
+            faces = self.recognizer.get(face_img_crop)
+            print("faces recognizer ran")
+            if not faces:
 
-            # Fallback: Try with smaller detection size for small crops
-            print("      [Identity] Primary detection failed. Trying backup (160x160)...")
-            faces = self.backup_recognizer.get(face_img_crop)
+                # Fallback: Try with smaller detection size for small crops
+                print("      [Identity] Primary detection failed. Trying backup (160x160)...")
+                s.set(backup=True)
+                faces = self.backup_recognizer.get(face_img_crop)
+            s.set(faces=len(faces))
 
         if not faces:
             # InsightFace detection inside the crop failed (e.g. AI face, cartoon, or blurry)
@@ -89,8 +94,10 @@ class FaceIdentitySystem:
             is_new = True
             
             # Encode crop to base64 for avatar
-            _, buffer = cv2.imencode('.jpg', face_img_crop)
-            crop_b64 = base64.b64encode(buffer).decode('utf-8')
+            with span("encode") as s:
+                _, buffer = cv2.imencode('.jpg', face_img_crop)
+                crop_b64 = base64.b64encode(buffer).decode('utf-8')
+                s.set(bytes=len(crop_b64))
             
             # Note: We cannot add to ChromaDB because we have no embedding.
             return person_id, person_name, is_new, crop_b64
@@ -104,10 +111,11 @@ class FaceIdentitySystem:
         # 2. Query ChromaDB
         print("querying chromadb...")
         try:
-            results = self.collection.query(
-                query_embeddings=[embedding],
-                n_results=1
-            )
+            with span("chroma_query", dim=len(embedding)):
+                results = self.collection.query(
+                    query_embeddings=[embedding],
+                    n_results=1
+                )
         except Exception as e:
             print(f"      [Identity] ChromaDB Query Failed: {str(e)}")
             results = {'distances': [[1.0]], 'metadatas': [[{'person_id': 'unrecognized', 'name': 'Unknown'}]]}
@@ -156,19 +164,22 @@ class FaceIdentitySystem:
         }
         try:
             print("trying to add to chromadb...")
-            self.collection.add(
-                ids=[sighting_id],
-                embeddings=[clean_embedding],
-                metadatas=[metadata] # Note: Chroma expects a list of dicts here
-            )
+            with span("chroma_add", dim=len(clean_embedding)):
+                self.collection.add(
+                    ids=[sighting_id],
+                    embeddings=[clean_embedding],
+                    metadatas=[metadata] # Note: Chroma expects a list of dicts here
+                )
             print("saving sighting done")
         except Exception as e:
             print(f"❌ [Identity] Critical error during collection.add: {e}")
         
         # Encode crop to base64
         print("encoding crop to base64...")
-        _, buffer = cv2.imencode('.jpg', face_img_crop)
-        crop_b64 = base64.b64encode(buffer).decode('utf-8')
+        with span("encode") as s:
+            _, buffer = cv2.imencode('.jpg', face_img_crop)
+            crop_b64 = base64.b64encode(buffer).decode('utf-8')
+            s.set(bytes=len(crop_b64))
         print("encoding crop to base64 done")
 
         return person_id, person_name, is_new, crop_b64
@@ -16,11 +16,14 @@ fake_mod = types.ModuleType("numpy.random._mt19937")
 fake_mod.MT19937 = mt.MT19937
 sys.modules["numpy.random._mt19937"] = fake_mod
 
+import hmac
 import joblib
+import json
 import os
 # import os
 os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
-from fastapi import FastAPI, UploadFile, File, Form, BackgroundTasks
+from fastapi import FastAPI, UploadFile, File, Form, BackgroundTasks, HTTPException, Header
+from fastapi.responses import PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 from skimage.feature import local_binary_pattern
@@ -31,6 +34,8 @@ from ultralytics import YOLO
 
 # NEW: Import Identity System
 from face_identity_system import FaceIdentitySystem
+# On-demand profiling (sampling + per-job span traces)
+from profiler import profiler, activate, span
 
 # --- 1. FEATURE EXTRACTOR ENGINE (The "Eyes") ---
 # This class must exactly match the logic used during training.
@@ -155,14 +160,19 @@ class FaceDetector:
                 return []
         
         # Convert bytes to cv2 image
-        nparr = np.frombuffer(img_bytes, np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        with span("decode", bytes=len(img_bytes)) as s:
+            nparr = np.frombuffer(img_bytes, np.uint8)
+            img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+            if img is not None:
+                s.set(shape=list(img.shape))
         if img is None: 
             print("❌ [FaceDetector] Failed to decode image bytes.")
             return []
 
         # Predict
-        results = self.model.predict(img, conf=0.25, verbose=False)
+        with span("detect") as s:
+            results = self.model.predict(img, conf=0.25, verbose=False)
+            s.set(boxes=len(results[0].boxes))
         print(f"🔹 [FaceDetector] Inference complete. Processing results...")
         
         # Format results
@@ -249,7 +259,11 @@ class Face(BaseModel):
 
 # --- 4. BACKGROUND TASKS ---
 
-async def process_ai_task(picture_id: str, file_bytes: bytes):
+async def process_ai_task(picture_id: str, file_bytes: bytes, trace=None):
+    with activate(trace), span("ai_task"):
+        await _process_ai_task(picture_id, file_bytes)
+
+async def _process_ai_task(picture_id: str, file_bytes: bytes):
     print(f"Processing AI for {picture_id}")
     
     is_ai = False
@@ -261,12 +275,14 @@ async def process_ai_task(picture_id: str, file_bytes: bytes):
 
         if model and extractor:
             # 1. Extract Features from bytes
-            features = extractor.process_image_from_bytes(file_bytes)
+            with span("ai_features", bytes=len(file_bytes)):
+                features = extractor.process_image_from_bytes(file_bytes)
             
             if features is not None:
                 # 2. Predict
-                prediction = model.predict(features)[0] # 0 = Real, 1 = AI
-                probs = model.predict_proba(features)[0] # [Prob_Real, Prob_AI]
+                with span("ai_predict"):
+                    prediction = model.predict(features)[0] # 0 = Real, 1 = AI
+                    probs = model.predict_proba(features)[0] # [Prob_Real, Prob_AI]
                 
                 is_ai = bool(prediction == 1)
                 confidence = float(probs[1]) if is_ai else float(probs[0])
@@ -281,21 +297,30 @@ async def process_ai_task(picture_id: str, file_bytes: bytes):
         print(f"❌ Critical AI Processing Error: {e}")
 
     # Callback to Backend
+    payload = {
+        "picture_id": picture_id, 
+        "is_ai": is_ai, 
+        "confidence": confidence
+    }
     async with aiohttp.ClientSession() as session:
         try:
-            await session.post(
-                "http://localhost:5000/api/upload/callback/ai",
-                json={
-                    "picture_id": picture_id, 
-                    "is_ai": is_ai, 
-                    "confidence": confidence
-                }
-            )
+            with span("callback", target="ai") as s:
+                if s.active:
+                    s.set(bytes=len(json.dumps(payload)))
+                resp = await session.post(
+                    "http://localhost:5000/api/upload/callback/ai",
+                    json=payload
+                )
+                s.set(status=resp.status)
             print(f"✅ AI Callback sent for {picture_id}")
         except Exception as e:
             print(f"⚠️ Failed to send AI callback: {e}")
 
-async def process_faces_task(picture_id: str, file_bytes: bytes):
+async def process_faces_task(picture_id: str, file_bytes: bytes, trace=None):
+    with activate(trace), span("faces_task"):
+        await _process_faces_task(picture_id, file_bytes)
+
+async def _process_faces_task(picture_id: str, file_bytes: bytes):
     print(f"🚀 [Task] Processing Faces for {picture_id}")
     
     faces = []
@@ -316,8 +341,9 @@ async def process_faces_task(picture_id: str, file_bytes: bytes):
             # 2. Identify Persons (if Identity System is loaded)
             if identity_system and len(faces) > 0:
                 print("🔹 [Task] Identifying people...")
-                nparr = np.frombuffer(file_bytes, np.uint8)
-                full_img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+                with span("decode", bytes=len(file_bytes)):
+                    nparr = np.frombuffer(file_bytes, np.uint8)
+                    full_img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
                 
                 for face in faces:
                     x, y, w, h = face["box"]["x"], face["box"]["y"], face["box"]["w"], face["box"]["h"]
@@ -340,7 +366,8 @@ async def process_faces_task(picture_id: str, file_bytes: bytes):
                         # print(f"   -> Face context: Box=[{x},{y},{w},{h}] | Pad=[{pad_w},{pad_h}] | Crop={face_crop.shape}")
                         print("🔹 [Task] Identifying cropped face...")
                         # Identify
-                        pid, name, is_new, crop_b64 = identity_system.identify_face(face_crop, file_path_hash=file_hash)
+                        with span("identify", face_id=face["face_id"]):
+                            pid, name, is_new, crop_b64 = identity_system.identify_face(face_crop, file_path_hash=file_hash)
                         print("Identified", pid, name, is_new)
                         if pid:
                             face["person_id"] = pid
@@ -360,13 +387,18 @@ async def process_faces_task(picture_id: str, file_bytes: bytes):
     except Exception as e:
         print(f"❌ [Task] Error detecting faces: {e}")
     
+    payload = {"picture_id": picture_id, "faces": faces}
     async with aiohttp.ClientSession() as session:
         try:
             print(f"📡 [Task] Sending callback to Backend with {len(faces)} faces...")
-            await session.post(
-                f"http://localhost:5000/api/upload/callback/faces",
-                json={"picture_id": picture_id, "faces": faces}
-            )
+            with span("callback", target="faces", faces=len(faces)) as s:
+                if s.active:
+                    s.set(bytes=len(json.dumps(payload)))
+                resp = await session.post(
+                    f"http://localhost:5000/api/upload/callback/faces",
+                    json=payload
+                )
+                s.set(status=resp.status)
             print(f"✅ [Task] Face Callback sent successfully for {picture_id}")
         except Exception as e:
             print(f"⚠️ [Task] Failed to send Face callback: {e}")
@@ -384,14 +416,85 @@ async def trigger_processing(
     file: UploadFile = File(...),
     picture_id: str = Form(...)
 ):
-    # READ FILE BYTES ONCE
-    # We read the bytes here because UploadFile is a stream. 
-    # Once the async function finishes, the stream closes.
-    file_bytes = await file.read()
+    # None unless an admin profiling session wants this job
+    trace = profiler.begin_job(picture_id)
+
+    with activate(trace):
+        # READ FILE BYTES ONCE
+        # We read the bytes here because UploadFile is a stream. 
+        # Once the async function finishes, the stream closes.
+        with span("upload_read") as s:
+            file_bytes = await file.read()
+            s.set(bytes=len(file_bytes))
     
     # Pass the bytes to the background task (instead of the filename)
-    background_tasks.add_task(process_ai_task, picture_id, file_bytes)
+    background_tasks.add_task(process_ai_task, picture_id, file_bytes, trace)
     # Re-use bytes for faces logic (Updated signature)
-    background_tasks.add_task(process_faces_task, picture_id, file_bytes)
+    background_tasks.add_task(process_faces_task, picture_id, file_bytes, trace)
     
-    return {"status": "processing_started", "message": "Background tasks triggered"}
\ No newline at end of file
+    return {"status": "processing_started", "message": "Background tasks triggered"}
+
+# --- 6. ADMIN: PROFILING ---
+# Disabled unless ML_ADMIN_TOKEN is set; callers must send it as X-Admin-Token.
+
+def _check_admin(token):
+    expected = os.environ.get("ML_ADMIN_TOKEN")
+    if not expected:
+        raise HTTPException(status_code=503, detail="Admin routes disabled: ML_ADMIN_TOKEN not set")
+    if token is None or not hmac.compare_digest(token.encode(), expected.encode()):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+class ProfileRequest(BaseModel):
+    seconds: float | None = None
+    jobs: int | None = None
+    interval_ms: int = 5
+
+@app.post("/admin/profile")
+def start_profile(req: ProfileRequest, x_admin_token: str | None = Header(None)):
+    """Samples the process for `seconds`, or until the next `jobs` uploads finish."""
+    _check_admin(x_admin_token)
+    try:
+        session = profiler.start(seconds=req.seconds, jobs=req.jobs, interval_ms=req.interval_ms)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return session.status()
+
+@app.post("/admin/profile/stop")
+def stop_profile(x_admin_token: str | None = Header(None)):
+    _check_admin(x_admin_token)
+    session = profiler.stop()
+    if session is None:
+        raise HTTPException(status_code=404, detail="No profiling session running")
+    return session.status()
+
+@app.get("/admin/profile")
+def list_profiles(x_admin_token: str | None = Header(None)):
+    _check_admin(x_admin_token)
+    session = profiler.session
+    return {
+        "active": session.status() if session else None,
+        "history": [s.status() for s in reversed(list(profiler.history))],
+    }
+
+def _get_session(session_id):
+    session = profiler.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Unknown profiling session")
+    return session
+
+@app.get("/admin/profile/{session_id}/flamegraph", response_class=PlainTextResponse)
+def profile_flamegraph(session_id: str, x_admin_token: str | None = Header(None)):
+    """Folded stacks, ready for flamegraph.pl or speedscope."""
+    _check_admin(x_admin_token)
+    session = _get_session(session_id)
+    if session.active:
+        raise HTTPException(status_code=409, detail="Session still running")
+    return session.folded()
+
+@app.get("/admin/profile/{session_id}/traces")
+def profile_traces(session_id: str, x_admin_token: str | None = Header(None)):
+    _check_admin(x_admin_token)
+    session = _get_session(session_id)
+    return {"session": session.status(), "traces": session.traces}
@@ -0,0 +1,352 @@
+import os
+import sys
+import json
+import time
+import uuid
+import threading
+import contextvars
+from collections import Counter, deque
+
+
+# --- On-demand profiling for the ML service ---
+# Nothing in here runs unless an admin starts a session (POST /admin/profile).
+# While idle, `span()` is a single ContextVar lookup and `begin_job()` a single
+# attribute check, so the hot path in process_faces_task stays untouched.
+
+# Anchored to this file so `uvicorn --app-dir ml_service` from the repo root still writes here
+PROFILES_DIR = os.environ.get(
+    "ML_PROFILES_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles"),
+)
+MAX_SECONDS = 600
+MAX_JOBS = 100
+KEEP_SESSIONS = 5
+
+_current_trace = contextvars.ContextVar("pixvault_trace", default=None)
+_current_span = contextvars.ContextVar("pixvault_span", default=None)
+
+
+class _NullSpan:
+    """Stand-in returned by span() when no trace is active."""
+    active = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span:
+    active = True
+
+    def __init__(self, trace, name, attrs):
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+        self.parent = None
+        self._token = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self.parent = _current_span.get()
+        self._token = _current_span.set(self.name)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        _current_span.reset(self._token)
+        record = {
+            "name": self.name,
+            "parent": self.parent,
+            "start_ms": round((self._start - self.trace.started) * 1000, 3),
+            "duration_ms": round((end - self._start) * 1000, 3),
+        }
+        if self.attrs:
+            record["attrs"] = self.attrs
+        if exc_type is not None:
+            record["error"] = f"{exc_type.__name__}: {exc}"
+        self.trace.spans.append(record)
+        return False
+
+
+class JobTrace:
+    """Span timeline for one /trigger-processing job (request + AI + faces tasks)."""
+
+    def __init__(self, session, picture_id, tasks):
+        self.session = session
+        self.picture_id = picture_id
+        self.started = time.perf_counter()
+        self.started_at = time.time()
+        self.spans = []
+        self.error = None
+        self._pending = tasks
+
+    def task_done(self):
+        if self._pending <= 0:
+            return
+        self._pending -= 1
+        if self._pending == 0:
+            self.session._job_finished(self)
+
+    def abandon(self, error):
+        """
+        Finishes the trace early. Used when a failure means the remaining
+        tasks will never run (failed upload read, Starlette skipping the
+        faces task after the AI task raised), so the job slot is released.
+        """
+        if self._pending <= 0:
+            return
+        self._pending = 0
+        self.error = error
+        self.session._job_finished(self)
+
+    def to_dict(self):
+        return {
+            "picture_id": self.picture_id,
+            "started_at": self.started_at,
+            "error": self.error,
+            "total_ms": round(max((s["start_ms"] + s["duration_ms"] for s in self.spans), default=0.0), 3),
+            "spans": sorted(self.spans, key=lambda s: s["start_ms"]),
+        }
+
+
+class _Sampler(threading.Thread):
+    """
+    Wall-clock stack sampler. Walks sys._current_frames() every `interval`
+    seconds and aggregates stacks in folded format (flamegraph.pl / speedscope).
+    """
+
+    def __init__(self, interval):
+        super().__init__(name="pixvault-profiler", daemon=True)
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        own_id = threading.get_ident()
+        names = {}
+        while not self._stop_event.wait(self.interval):
+            for t in threading.enumerate():
+                names[t.ident] = t.name
+            for tid, frame in sys._current_frames().items():
+                if tid == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(tid, f"thread-{tid}"))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def folded(self):
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+
+class ProfileSession:
+    def __init__(self, owner, seconds=None, jobs=None, interval_ms=5):
+        self.owner = owner
+        self.id = uuid.uuid4().hex[:8]
+        self.seconds = seconds
+        self.jobs = jobs
+        self.interval_ms = interval_ms
+        self.started_at = time.time()
+        self.finished_at = None
+        self.stop_reason = None
+        self.traces = []
+        self._jobs_claimed = 0
+        self._jobs_open = 0
+        self._sampler = _Sampler(interval_ms / 1000.0)
+        self._timer = None
+
+    @property
+    def active(self):
+        return self.finished_at is None
+
+    def claim_job(self):
+        if self.jobs is None:
+            return True
+        if self._jobs_claimed >= self.jobs:
+            return False
+        self._jobs_claimed += 1
+        return True
+
+    def _job_finished(self, trace):
+        with self.owner._lock:
+            self.traces.append(trace.to_dict())
+            self._jobs_open -= 1
+            late = not self.active
+        if late:
+            # Job was still running when the session stopped; refresh traces.json
+            self.owner._dump(self)
+        elif self.jobs is not None and len(self.traces) >= self.jobs:
+            self.owner.stop(reason="jobs", session=self)
+
+    def folded(self):
+        return self._sampler.folded()
+
+    def status(self):
+        return {
+            "id": self.id,
+            "active": self.active,
+            "seconds": self.seconds,
+            "jobs": self.jobs,
+            "interval_ms": self.interval_ms,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "stop_reason": self.stop_reason,
+            "samples": self._sampler.samples,
+            "jobs_traced": len(self.traces),
+            "jobs_in_flight": self._jobs_open,
+        }
+
+
+class Profiler:
+    """
+    Process-wide profiling switch. At most one session runs at a time;
+    the last few finished sessions stay in memory and on disk under PROFILES_DIR.
+    """
+
+    def __init__(self):
+        self.session = None
+        self.history = deque(maxlen=KEEP_SESSIONS)
+        self._lock = threading.Lock()
+
+    def start(self, seconds=None, jobs=None, interval_ms=5):
+        if seconds is None and jobs is None:
+            seconds = 30
+        if seconds is not None and not 0 < seconds <= MAX_SECONDS:
+            raise ValueError(f"seconds must be in (0, {MAX_SECONDS}]")
+        if jobs is not None and not 0 < jobs <= MAX_JOBS:
+            raise ValueError(f"jobs must be in (0, {MAX_JOBS}]")
+        if not 1 <= interval_ms <= 1000:
+            raise ValueError("interval_ms must be in [1, 1000]")
+
+        with self._lock:
+            if self.session is not None:
+                raise RuntimeError(f"Profiling session {self.session.id} already running")
+            session = ProfileSession(self, seconds=seconds, jobs=jobs, interval_ms=interval_ms)
+            self.session = session
+
+        session._sampler.start()
+        # Job-count sessions still get a hard cap so a quiet service can't sample forever
+        timeout = seconds if seconds is not None else MAX_SECONDS
+        session._timer = threading.Timer(timeout, self.stop, kwargs={"reason": "timeout", "session": session})
+        session._timer.daemon = True
+        session._timer.start()
+        print(f"🔬 [Profiler] Session {session.id} started (seconds={seconds}, jobs={jobs}, interval={interval_ms}ms)")
+        return session
+
+    def stop(self, reason="manual", session=None):
+        """Stops the running session (or only `session`, if given and still running)."""
+        with self._lock:
+            if self.session is None or (session is not None and session is not self.session):
+                return None
+            session = self.session
+            self.session = None
+            # Set under the lock so _job_finished can tell which jobs missed the dump below
+            session.finished_at = time.time()
+            session.stop_reason = reason
+
+        if session._timer is not None:
+            session._timer.cancel()
+        session._sampler.stop()
+        self.history.append(session)
+        self._dump(session)
+        print(f"🔬 [Profiler] Session {session.id} stopped ({reason}): "
+              f"{session._sampler.samples} samples, {len(session.traces)} job traces")
+        return session
+
+    def get(self, session_id):
+        current = self.session
+        if current is not None and current.id == session_id:
+            return current
+        for session in list(self.history):
+            if session.id == session_id:
+                return session
+        return None
+
+    def begin_job(self, picture_id, tasks=3):
+        """Returns a JobTrace if the current session wants this job, else None."""
+        session = self.session
+        if session is None:
+            return None
+        with self._lock:
+            if not session.active or not session.claim_job():
+                return None
+            session._jobs_open += 1
+        return JobTrace(session, picture_id, tasks)
+
+    def _dump(self, session):
+        out_dir = os.path.join(PROFILES_DIR, session.id)
+        try:
+            os.makedirs(out_dir, exist_ok=True)
+            with self._lock:
+                folded = session.folded()
+                data = {"session": session.status(), "traces": list(session.traces)}
+            self._write(os.path.join(out_dir, "stacks.folded"), folded)
+            self._write(os.path.join(out_dir, "traces.json"), json.dumps(data, indent=2))
+        except OSError as e:
+            print(f"⚠️ [Profiler] Failed to write profile to {out_dir}: {e}")
+
+    @staticmethod
+    def _write(path, text):
+        # Late jobs may rewrite traces.json from another thread; replace atomically
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "w") as f:
+            f.write(text)
+        os.replace(tmp, path)
+
+
+profiler = Profiler()
+
+
+class activate:
+    """
+    Binds a JobTrace to the current task for the duration of the block and
+    marks the task done on exit. If the block raises, the whole trace is
+    abandoned, since the tasks queued after it will not run. A None trace
+    makes this a no-op.
+    """
+
+    def __init__(self, trace):
+        self.trace = trace
+        self._token = None
+
+    def __enter__(self):
+        if self.trace is not None:
+            self._token = _current_trace.set(self.trace)
+        return self.trace
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.trace is not None:
+            _current_trace.reset(self._token)
+            if exc_type is None:
+                self.trace.task_done()
+            else:
+                self.trace.abandon(f"{exc_type.__name__}: {exc}")
+        return False
+
+
+def span(name, **attrs):
+    """Times a block under the active job trace; free when nothing is traced."""
+    trace = _current_trace.get()
+    if trace is None:
+        return _NULL_SPAN
+    return Span(trace, name, attrs)
@@ -0,0 +1,101 @@
+import json
+import os
+
+import pytest
+
+import profiler as profiler_mod
+from profiler import Profiler, activate, span
+
+
+@pytest.fixture
+def prof(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiler_mod, "PROFILES_DIR", str(tmp_path))
+    p = Profiler()
+    yield p
+    p.stop()
+
+
+def run_job(p, picture_id):
+    """Mimics /trigger-processing: request read, then the AI and faces tasks."""
+    trace = p.begin_job(picture_id)
+    for task in ("upload_read", "ai_task", "faces_task"):
+        with activate(trace), span(task):
+            with span("decode", bytes=10):
+                pass
+    return trace
+
+
+def read_traces(session):
+    with open(os.path.join(profiler_mod.PROFILES_DIR, session.id, "traces.json")) as f:
+        return json.load(f)["traces"]
+
+
+def test_span_is_noop_without_session(prof):
+    with span("decode") as s:
+        s.set(bytes=1)
+    assert not s.active
+    assert prof.begin_job("pic") is None
+    with activate(None):
+        assert span("detect") is span("embed")
+
+
+def test_jobs_session_stops_after_k_jobs(prof):
+    session = prof.start(jobs=2, interval_ms=1)
+    run_job(prof, "a")
+    assert session.active
+    run_job(prof, "b")
+
+    assert not session.active
+    assert session.stop_reason == "jobs"
+    assert prof.session is None
+    assert prof.begin_job("c") is None
+
+    traces = read_traces(session)
+    assert [t["picture_id"] for t in traces] == ["a", "b"]
+    names = [s["name"] for s in traces[0]["spans"]]
+    assert names == ["upload_read", "decode", "ai_task", "decode", "faces_task", "decode"]
+    assert traces[0]["spans"][1]["parent"] == "upload_read"
+    assert os.path.exists(os.path.join(profiler_mod.PROFILES_DIR, session.id, "stacks.folded"))
+
+
+def test_failed_upload_read_releases_job(prof):
+    session = prof.start(jobs=1, interval_ms=1)
+    trace = prof.begin_job("a")
+    with pytest.raises(OSError):
+        with activate(trace), span("upload_read"):
+            raise OSError("client disconnected")
+
+    assert session.stop_reason == "jobs"
+    assert session.status()["jobs_in_flight"] == 0
+    assert session.traces[0]["error"] == "OSError: client disconnected"
+
+
+def test_failed_ai_task_releases_job(prof):
+    session = prof.start(jobs=1, interval_ms=1)
+    trace = prof.begin_job("a")
+    with activate(trace), span("upload_read"):
+        pass
+    with pytest.raises(RuntimeError):
+        with activate(trace), span("ai_task"):
+            raise RuntimeError("boom")
+    # Starlette skips process_faces_task after the AI task raises
+
+    assert session.stop_reason == "jobs"
+    assert session.status()["jobs_in_flight"] == 0
+    assert [s["name"] for s in session.traces[0]["spans"]] == ["upload_read", "ai_task"]
+
+
+def test_job_finishing_after_stop_is_written(prof):
+    session = prof.start(seconds=60, interval_ms=1)
+    trace = prof.begin_job("slow")
+    with activate(trace):
+        pass
+    prof.stop(reason="timeout")
+    assert read_traces(session) == []
+
+    for _ in range(2):
+        with activate(trace), span("faces_task"):
+            pass
+
+    assert session.status()["jobs_in_flight"] == 0
+    assert [t["picture_id"] for t in read_traces(session)] == ["slow"]